@@ -3,35 +3,15 @@
 """
   esoteric requirements:
     - infoblox-client (installable through pip)
-  TODO:
-    - add External/Internal view for Infoblox (now we've hardcoded External)
 """
 import os
 import argparse
 import textwrap
-import platform
-import ConfigParser
-from infoblox_client import connector
-from infoblox_client import objects
+import iblox_engine
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 
-if platform.system() == 'Windows':
-    IBLOX_CONF = os.path.join(os.path.expanduser('~'), 'iblox.cfg')
-else:
-    IBLOX_CONF = os.path.join(os.environ['HOME'], '.ibloxrc')
-
-IBLOX_CONF_CONTENT = """[iblox]\n
-# Infoblox server <string>: infblox server fqdn
-iblox_server = infoblox.foo.bar.com\n
-# Infoblox username <string>: your_username
-iblox_username = your_username\n
-# Infoblox password <string>: your_password
-iblox_password = your_secret_pass_here\n
-"""
-
-
 def parse():
     """ parse arguments """
 
@@ -40,6 +20,7 @@ def parse():
         -----------------------------------------------------------------------
         Adding: iblox_cname.py --host test-foo01.bar.com --alias foo.bar.com
         Removing: iblox_cname.py --alias foo.bar.com --destroy
+        Bulk: iblox_cname.py --batch aliases.txt (one "alias host" per line)
         Hint: If you add an alias, you will implicitly replace any existing entry which is
               different from the one provided to the script
          """
@@ -50,104 +31,95 @@ def parse():
         epilog="Author: Massimiliano Adamo <massimiliano.adamo@geant.org>")
 
     parser.add_argument('--host', help='existing host name. Mandatory when creating an alias')
-    parser.add_argument('--alias', help='alias to create. Mandatory', required=True)
+    parser.add_argument('--alias', help='alias to create. Mandatory unless --batch is used')
     parser.add_argument('--network', help='network Internal/External',
                         choices=['External', 'Internal'], required=True)
     parser.add_argument('--destroy', help='destroy alias', action='store_true')
+    parser.add_argument('--batch', help='file with one "alias host" per line')
+    parser.add_argument('--journal', help='journal of the batch. Default: <batch>.journal')
 
     return parser.parse_args()
 
 
-class Iblox(object):
-    """manage infoblox entries"""
-    config = ConfigParser.RawConfigParser()
+class Iblox(iblox_engine.Iblox):
+    """manage infoblox CNAME entries"""
 
-    def __init__(self, network, record, alias):
-        self.network = network
+    def __init__(self, network, record, alias, conn=None):
+        super(Iblox, self).__init__(network, conn)
         self.record = record
         self.alias = alias
-        self.config.readfp(open(IBLOX_CONF))
-        self.opts = {
-            'host': self.config.get('iblox', 'iblox_server'),
-            'username': self.config.get('iblox', 'iblox_username'),
-            'password': self.config.get('iblox', 'iblox_password')
-            }
-        self.conn = connector.Connector(self.opts)
-
-    def query_alias(self):
-        """ query for CNAME record: return None if it does not exist or
-            if self.alias matches the existing one """
-        try:
-            alias_rec = self.conn.get_object('record:cname', {'name': self.alias})[0]
-        except TypeError:
-            return None
-        else:
-            if self.record == str(alias_rec['canonical']):
-                return 'already_there'
-            else:
-                return alias_rec
 
     def destroy(self):
         """ clean up CNAME entry """
-        try:
-            self.conn.delete_object(self.conn.get_object(
-                'record:cname', {'name': self.alias})[0]['_ref'])
-        except TypeError:
-            print "cound not find CNAME {}".format(self.alias)
-        else:
-            print "destroyed CNAME {}".format(self.alias)
-
-    def destroy_conditional(self):
-        """ clean up host entries """
-        alias_entry = self.query_alias()
-        if alias_entry and alias_entry != 'already_there':
-            self.conn.delete_object(alias_entry['_ref'])
-            print "destroyed CNAME record {}".format(self.alias)
-            return 'did something'
-        elif alias_entry == 'already_there':
-            return 'already_there'
-        else:
-            return None
-
-    def rebuild(self):
-        """ - destroy alias record (if it is not matching)
+        ops = self.plan_destroy(iblox_engine.CNAME, name=self.alias)
+        if not ops:
+            print "could not find CNAME {}".format(self.alias)
+        self.run(ops)
+
+    def plan(self):
+        """ return the operations needed to rebuild the alias:
+            - destroy alias record (if it is not matching)
             - create a new alias record if there isn't one already
         """
+        return self.plan_record(iblox_engine.CNAME, name=self.alias, canonical=self.record)
 
-        try_destroy = self.destroy_conditional()
-
-        if try_destroy == 'already_there':
-            print "A CNAME {} associated to {} is already there".format(
-                self.alias, self.record)
-        else:
-            try:
-                objects.CNAMERecord.create(self.conn, view=self.network,
-                                           name=self.alias, canonical=self.record)
-            except Exception as err:
-                print "couldn't create CNAME {} to Record {}: {}".format(
-                    self.alias, self.record, err)
-                os.sys.exit(1)
-            else:
-                print "created CNAME record {} associated to {}".format(
-                    self.alias, self.record)
+    def rebuild(self):
+        """ run the operations returned by plan() """
+        self.run(self.plan())
 
         print '-'*74
 
 
+def same_domain(host, alias):
+    """ True if host and alias live in the same domain """
+    return host.split('.')[1:] == alias.split('.')[1:]
+
+
+def check_line(fields):
+    """ validate an 'alias host' batch line and return the keys it replaces """
+    if len(fields) != 2:
+        raise ValueError("expected 'alias host', got {} fields".format(len(fields)))
+    alias, host = fields
+    if not same_domain(host, alias):
+        raise ValueError("host {} and alias {} must be in the same domain".format(host, alias))
+    return [('alias', alias)]
+
+
+def plan_line(network, fields, conn):
+    """ operations rebuilding an 'alias host' batch line """
+    alias, host = fields
+    return Iblox(network, host, alias, conn).plan()
+
+
 if __name__ == '__main__':
     print '-'*74
     requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
-    if not os.access(IBLOX_CONF, os.W_OK):
-        CONF_FILE = open(IBLOX_CONF, 'w+')
-        CONF_FILE.write(IBLOX_CONF_CONTENT)
-        CONF_FILE.close()
-        print "\nThe following file has been created: {0}\n".format(IBLOX_CONF)
-        print "Fill it with proper values and run the script again\n"
-        os.sys.exit(1)
+    iblox_engine.check_config()
 
     ARGS = parse()
 
+    if ARGS.batch:
+        for OPTION in ('destroy', 'host', 'alias'):
+            if getattr(ARGS, OPTION):
+                print " --{} can't be used with --batch".format(OPTION)
+                print " You can use --help to check the options"
+                os.sys.exit(1)
+        iblox_engine.run_batch(ARGS.network, ARGS.batch,
+                               ARGS.journal or ARGS.batch + '.journal',
+                               plan_line, check_line)
+        os.sys.exit()
+
+    if ARGS.journal:
+        print " --journal can only be used with --batch"
+        print " You can use --help to check the options"
+        os.sys.exit(1)
+
+    if not ARGS.alias:
+        print " --alias is mandatory unless you use --batch"
+        print " You can use --help to check the options"
+        os.sys.exit()
+
     if not ARGS.destroy:
         if not ARGS.host:
             print " --host is mandatory when you create a new record"
@@ -156,19 +128,20 @@ if __name__ == '__main__':
         else:
             HOST = ARGS.host
     else:
-        if not ARGS.host:
-            HOST = 'blah'
+        HOST = ARGS.host or 'blah'
 
-    if ARGS.destroy:
-        Iblox(HOST, ARGS.alias).destroy()
-    else:
-        ALIAS_LIST = ARGS.alias.split('.')
-        del ALIAS_LIST[0]
-        HOST_LIST = HOST.split('.')
-        del HOST_LIST[0]
-        if HOST_LIST != ALIAS_LIST:
-            print "host and alias must be in the same domain"
-            print "Example: iblox.py --alias foo.bar.com --host prod-foo01.bar.com"
-            print "giving up..."
-            os.sys.exit(1)
-        Iblox(HOST, ARGS.alias).rebuild()
+    if not ARGS.destroy and not same_domain(HOST, ARGS.alias):
+        print "host and alias must be in the same domain"
+        print "Example: iblox.py --alias foo.bar.com --host prod-foo01.bar.com"
+        print "giving up..."
+        os.sys.exit(1)
+
+    try:
+        if ARGS.destroy:
+            Iblox(ARGS.network, HOST, ARGS.alias).destroy()
+        else:
+            Iblox(ARGS.network, HOST, ARGS.alias).rebuild()
+    except iblox_engine.WapiError as err:
+        print err
+        print "giving up..."
+        os.sys.exit(1)
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+#
+"""
+  record-type engine shared by the iblox scripts: configuration bootstrap,
+  queries, destroy and rebuild of any record type described by a RecordType
+
+  esoteric requirements:
+    - infoblox-client (installable through pip)
+"""
+import os
+import json
+import platform
+import collections
+import ConfigParser
+import iblox_journal
+from infoblox_client import connector
+
+
+if platform.system() == 'Windows':
+    IBLOX_CONF = os.path.join(os.path.expanduser('~'), 'iblox.cfg')
+else:
+    IBLOX_CONF = os.path.join(os.environ['HOME'], '.ibloxrc')
+
+IBLOX_CONF_CONTENT = """[iblox]\n
+# Infoblox server <string>: infblox server fqdn
+iblox_server = infoblox.foo.bar.com\n
+# Infoblox username <string>: your_username
+iblox_username = your_username\n
+# Infoblox password <string>: your_password
+iblox_password = your_secret_pass_here\n
+# Infoblox WAPI version <string>: paging and bulk requests need a version newer than 1.4
+# iblox_wapi_version = 2.5\n
+"""
+
+# records fetched per request by fetch_all()
+PAGE_SIZE = 1000
+
+# label: used in the messages
+# obj_type: WAPI object type
+# key_fields: fields identifying the record
+# compare_fields: fields of a record which is already there
+# single: only one record can hold the key fields, so a replaced record
+#         must be destroyed before the new one is created
+RecordType = collections.namedtuple(
+    'RecordType', ['label', 'obj_type', 'key_fields', 'compare_fields', 'single'])
+
+HOST = RecordType('host record', 'record:host', ('name',), (), False)
+A = RecordType('A Record', 'record:a', ('name',), ('ipv4addr',), False)
+AAAA = RecordType('AAAA Record', 'record:aaaa', ('name',), ('ipv6addr',), False)
+PTR = RecordType('PTR Record', 'record:ptr', ('ptrdname',), ('ipv4addr', 'ipv6addr'), False)
+PTR4 = RecordType('PTR Record', 'record:ptr', ('ipv4addr',), ('ptrdname',), False)
+PTR6 = RecordType('PTR v6 Record', 'record:ptr', ('ipv6addr',), ('ptrdname',), False)
+CNAME = RecordType('CNAME', 'record:cname', ('name',), ('canonical',), True)
+TXT = RecordType('TXT record', 'record:txt', ('name', 'text'), (), False)
+MX = RecordType('MX record', 'record:mx', ('name', 'mail_exchanger'), ('preference',), False)
+SRV = RecordType('SRV record', 'record:srv', ('name', 'target', 'port'),
+                 ('priority', 'weight'), False)
+NS = RecordType('NS record', 'record:ns', ('name', 'nameserver'), (), False)
+
+
+def check_config():
+    """ create an empty configuration file and exit if there isn't one """
+    if not os.access(IBLOX_CONF, os.W_OK):
+        conf_file = open(IBLOX_CONF, 'w+')
+        conf_file.write(IBLOX_CONF_CONTENT)
+        conf_file.close()
+        print "\nThe following file has been created: {0}\n".format(IBLOX_CONF)
+        print "Fill it with proper values and run the script again\n"
+        os.sys.exit(1)
+
+
+def connect():
+    """ return a connector configured from IBLOX_CONF """
+    config = ConfigParser.RawConfigParser()
+    config.readfp(open(IBLOX_CONF))
+    opts = {
+        'host': config.get('iblox', 'iblox_server'),
+        'username': config.get('iblox', 'iblox_username'),
+        'password': config.get('iblox', 'iblox_password')
+        }
+    if config.has_option('iblox', 'iblox_wapi_version'):
+        opts['wapi_version'] = config.get('iblox', 'iblox_wapi_version')
+    return connector.Connector(opts)
+
+
+class WapiError(Exception):
+    """a WAPI request failed"""
+    pass
+
+
+def fetch_all(conn, obj_type, search, return_fields, paging=True):
+    """ return every obj_type record matching search, page by page unless
+        paging is False (WAPI 1.4 has no paging). Unlike conn.get_object(),
+        raise WapiError if a request fails """
+    params = dict(search, _return_fields=','.join(return_fields))
+    if paging:
+        params.update(_paging=1, _return_as_object=1, _max_results=PAGE_SIZE)
+    records = []
+    while True:
+        reply = iblox_journal.wapi_get(conn, obj_type, params)
+        if reply.status_code != 200:
+            raise WapiError("couldn't fetch {}: {}".format(obj_type, reply.content))
+        page = json.loads(reply.content)
+        if not paging:
+            return page
+        records.extend(page['result'])
+        if not page.get('next_page_id'):
+            return records
+        params = {'_page_id': page['next_page_id']}
+
+
+def describe(rtype, fields):
+    """ human readable description of a record """
+    keys = u' '.join(iblox_journal.text(fields[key])
+                     for key in rtype.key_fields if fields.get(key))
+    values = u', '.join(u'{} {}'.format(field, iblox_journal.text(fields[field]))
+                        for field in rtype.compare_fields if fields.get(field))
+    if values:
+        return u'{} {} with {}'.format(rtype.label, keys, values)
+    return u'{} {}'.format(rtype.label, keys)
+
+
+class Iblox(object):
+    """manage infoblox entries of any record type"""
+
+    def __init__(self, network, conn=None):
+        self.network = network
+        self.conn = conn or connect()
+
+    def query(self, rtype, **search):
+        """ return the rtype records of the view matching search, fetching only
+            the fields the engine needs. A failed query raises WapiError: it
+            must not look like a missing record """
+        search['view'] = self.network
+        return fetch_all(self.conn, rtype.obj_type, search,
+                         rtype.key_fields + rtype.compare_fields, paging=False)
+
+    def plan_delete(self, rtype, rec):
+        """ return the operation destroying rec, a record returned by query() """
+        search = dict((field, rec[field]) for field in rtype.key_fields if rec.get(field))
+        search['view'] = self.network
+        return iblox_journal.delete_op(
+            rec['_ref'], u'destroyed {}'.format(describe(rtype, rec)),
+            u"couldn't destroy {}".format(describe(rtype, rec)), rtype.obj_type, search)
+
+    def plan_destroy(self, rtype, **search):
+        """ return the operations destroying the rtype records matching search """
+        return [self.plan_delete(rtype, rec) for rec in self.query(rtype, **search)]
+
+    def plan_record(self, rtype, **fields):
+        """ return the operations replacing the rtype records sharing the key
+            fields with a single record holding fields: nothing is done if
+            it's already there. The new record is created before the old ones
+            are destroyed, unless rtype is single """
+        key = dict((field, fields[field]) for field in rtype.key_fields)
+        deletes = []
+        already_there = False
+        for rec in self.query(rtype, **key):
+            if not already_there and all(
+                    iblox_journal.text(rec.get(field)) == iblox_journal.text(fields[field])
+                    for field in rtype.compare_fields):
+                already_there = True
+            else:
+                deletes.append(self.plan_delete(rtype, rec))
+        if already_there:
+            return [iblox_journal.note_op(
+                u'{} is already there'.format(describe(rtype, fields)))] + deletes
+        payload = dict(fields, view=self.network)
+        create = iblox_journal.create_op(
+            rtype.obj_type, payload, u'created {}'.format(describe(rtype, fields)),
+            u"couldn't create {}".format(describe(rtype, fields)))
+        if rtype.single:
+            return deletes + [create]
+        return [create] + deletes
+
+    def run(self, ops):
+        """ run the operations, exit at the first failure telling which
+            records were already destroyed """
+        try:
+            iblox_journal.run_plan(self.conn, ops)
+        except iblox_journal.JournalError as err:
+            iblox_journal.echo(err)
+            done = [op for op in ops[:err.step] if op['op'] == 'delete']
+            if done:
+                print "these records were destroyed before the failure:"
+                for op in done:
+                    iblox_journal.echo(u"  {}".format(op['msg']))
+            os.sys.exit(1)
+
+
+def load_batch(batch_file, check_line):
+    """ return the fields of every line of batch_file. check_line(fields)
+        returns the keys of the records a line replaces, or raises ValueError
+        if the line is malformed: a key showing up twice is an error too, as
+        every line is planned against the state preceding the batch """
+    lines = []
+    seen = {}
+    errors = []
+    for lineno, fields in iblox_journal.read_batch(batch_file):
+        try:
+            keys = check_line(fields)
+        except ValueError as err:
+            errors.append('{}:{}: {}'.format(batch_file, lineno, err))
+            continue
+        for key in keys:
+            if key in seen:
+                errors.append('{}:{}: duplicate {} {}, already on line {}'.format(
+                    batch_file, lineno, key[0], key[1], seen[key]))
+            else:
+                seen[key] = lineno
+        lines.append(fields)
+    if errors:
+        print '\n'.join(errors)
+        print "giving up..."
+        os.sys.exit(1)
+    return lines
+
+
+def run_batch(network, batch_file, journal_file, plan_line, check_line):
+    """ run the operations returned by plan_line(network, fields, conn) for
+        every line of batch_file, through a journal. If the journal holds an
+        unfinished plan of the same batch_file and network, resume it instead
+        of querying again. Verify the outcome at the end """
+    conn = connect()
+    origin = {'batch': iblox_journal.file_digest(batch_file), 'network': network}
+    journal = iblox_journal.Journal(journal_file)
+    if journal.is_complete():
+        # a finished plan is history: plan the batch file again
+        journal.reset()
+    elif journal.sealed and journal.origin != origin:
+        print "{} was planned from another {} or --network".format(journal_file, batch_file)
+        print "run it with the original file or delete it to plan {} again".format(batch_file)
+        os.sys.exit(1)
+    if not journal.sealed:
+        ops = []
+        planned_refs = set()
+        try:
+            for fields in load_batch(batch_file, check_line):
+                for op in plan_line(network, fields, conn):
+                    if op['op'] == 'delete':
+                        if op['ref'] in planned_refs:
+                            continue
+                        planned_refs.add(op['ref'])
+                    ops.append(op)
+        except WapiError as err:
+            # nothing is sealed: the next run plans again
+            print err
+            print "giving up..."
+            os.sys.exit(1)
+        journal.plan(ops, origin)
+        print "planned {} operations in {}".format(len(journal.steps), journal_file)
+    else:
+        print "resuming {} from step {}".format(
+            journal_file, len(journal.steps) - len(list(journal.pending())))
+
+    try:
+        iblox_journal.run_plan(conn, journal.steps, journal)
+    except iblox_journal.JournalError as err:
+        iblox_journal.echo(err)
+        print "run the same command again to resume from {}".format(journal_file)
+        os.sys.exit(1)
+    finally:
+        journal.close()
+
+    try:
+        failed = iblox_journal.verify(conn, journal.steps)
+    except iblox_journal.JournalError as err:
+        iblox_journal.echo(err)
+        os.sys.exit(1)
+    for op in failed:
+        iblox_journal.echo(u"verification failed: {}".format(op['err']))
+    if failed:
+        os.sys.exit(1)
+    print "verified {} created and {} destroyed records".format(
+        len([op for op in journal.steps if op['op'] == 'create']),
+        len([op for op in journal.steps if op['op'] == 'delete' and 'search' in op]))
+    print '-'*74
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+#
+"""
+  write-ahead journal for bulk jobs: every operation is written to a JSONL
+  file before it runs, so that a crashed or rate-limited run can be
+  restarted from the last committed step without querying Infoblox again
+"""
+import os
+import json
+import urllib
+import hashlib
+
+
+class JournalError(Exception):
+    """an operation of the plan could not be applied: step is its index"""
+
+    def __init__(self, message, step=None):
+        super(JournalError, self).__init__(message)
+        self.step = step
+
+
+def text(value):
+    """ unicode form of value: WAPI returns unicode, while the command line
+        and most exception messages are UTF-8 bytes """
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    try:
+        return unicode(value)
+    except UnicodeError:
+        return str(value).decode('utf-8', 'replace')
+
+
+def echo(msg):
+    """ print msg, which may hold non-ASCII record values, as UTF-8 even
+        when stdout is not a terminal """
+    print text(msg).encode('utf-8')
+
+
+def delete_op(ref, msg, err, obj_type, search):
+    """ operation deleting the object behind ref: the obj_type objects
+        matching search must not include it any longer """
+    return {'op': 'delete', 'ref': ref, 'msg': msg, 'err': err,
+            'obj_type': obj_type, 'search': search}
+
+
+def create_op(obj_type, payload, msg, err):
+    """ operation creating an obj_type object holding payload """
+    return {'op': 'create', 'obj_type': obj_type, 'payload': payload,
+            'msg': msg, 'err': err}
+
+
+def note_op(msg):
+    """ operation doing nothing but printing msg """
+    return {'op': 'note', 'msg': msg}
+
+
+class Journal(object):
+    """append-only JSONL journal: one 'planned' line per operation, a 'sealed'
+       line once the plan is complete, then 'started'/'done' lines per step.
+       The 'sealed' line holds the origin of the plan (e.g. its batch file)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.steps = []
+        self.state = {}
+        self.sealed = False
+        self.origin = None
+        if os.path.exists(path):
+            self._load()
+        if not self.sealed:
+            # an unsealed plan is incomplete: nothing has run yet, plan() starts over
+            self.steps = []
+            self.state = {}
+            self.origin = None
+            self.jfile = None
+        else:
+            self.jfile = open(path, 'a')
+
+    def _load(self):
+        """ read back the journal, ignoring a torn last line """
+        with open(self.path) as jfile:
+            for line in jfile:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry['state'] == 'planned':
+                    self.steps.append(entry['op'])
+                elif entry['state'] == 'sealed':
+                    self.sealed = True
+                    self.origin = entry.get('origin')
+                else:
+                    self.state[entry['step']] = entry['state']
+
+    def _append(self, entry):
+        self.jfile.write(json.dumps(entry) + '\n')
+        self.jfile.flush()
+        os.fsync(self.jfile.fileno())
+
+    def plan(self, ops, origin=None):
+        """ record the operations to run, unless a sealed plan is already there """
+        if self.sealed:
+            return
+        self.jfile = open(self.path, 'w')
+        for step, op in enumerate(ops):
+            self.jfile.write(json.dumps({'step': step, 'state': 'planned', 'op': op}) + '\n')
+        self._append({'state': 'sealed', 'origin': origin})
+        self.steps = list(ops)
+        self.sealed = True
+        self.origin = origin
+
+    def pending(self):
+        """ yield (step, op, started) for every operation not done yet """
+        for step, op in enumerate(self.steps):
+            state = self.state.get(step)
+            if state != 'done':
+                yield step, op, state == 'started'
+
+    def mark(self, step, state):
+        """ commit the state of a step to disk """
+        self.state[step] = state
+        self._append({'step': step, 'state': state})
+
+    def is_complete(self):
+        """ True when every planned step is done """
+        return self.sealed and all(
+            self.state.get(step) == 'done' for step in range(len(self.steps)))
+
+    def reset(self):
+        """ drop the plan: the next plan() overwrites the journal """
+        self.close()
+        self.steps = []
+        self.state = {}
+        self.sealed = False
+        self.origin = None
+        self.jfile = None
+
+    def close(self):
+        if self.jfile:
+            self.jfile.close()
+
+
+def wapi_get(conn, path, params=None):
+    """ GET path from WAPI and return the reply, whatever its status.
+        conn.get_object() can't tell an error from an empty result """
+    return conn.session.get(conn.wapi_url + urllib.quote(path), params=params,
+                            headers={'Content-type': 'application/json'},
+                            timeout=conn.http_request_timeout)
+
+
+def is_created(conn, op):
+    """ True if the object of a create operation is on Infoblox """
+    reply = wapi_get(conn, op['obj_type'], op['payload'])
+    if reply.status_code != 200:
+        raise JournalError("couldn't look for {}: {}".format(op['obj_type'], reply.content))
+    return bool(json.loads(reply.content))
+
+
+def apply_op(conn, op, started=False):
+    """ run a single operation; started tells that a previous run may have
+        already applied it, in which case it is checked before it's replayed """
+    if op['op'] == 'delete':
+        try:
+            conn.delete_object(op['ref'])
+        except Exception:
+            # the delete went through before the crash only if the ref is gone
+            if not started or wapi_get(conn, op['ref']).status_code != 404:
+                raise
+    elif op['op'] == 'create':
+        if not started or not is_created(conn, op):
+            conn.create_object(op['obj_type'], op['payload'])
+    echo(op['msg'])
+
+
+def run_plan(conn, ops, journal=None):
+    """ run ops in order, committing every step to the journal if there is one.
+        Raise JournalError at the first failure """
+    if journal is None:
+        pending = ((step, op, False) for step, op in enumerate(ops))
+    else:
+        journal.plan(ops)
+        pending = journal.pending()
+
+    for step, op, started in pending:
+        if journal is not None:
+            journal.mark(step, 'started')
+        try:
+            apply_op(conn, op, started)
+        except Exception as err:
+            raise JournalError(u"{}: {}".format(text(op.get('err', op['msg'])), text(err)), step)
+        if journal is not None:
+            journal.mark(step, 'done')
+
+
+def verify(conn, ops):
+    """ check the outcome of every create and delete with a single WAPI
+        multi-request: return the list of operations whose object can't be
+        found (create) or is still there (delete) """
+    # a delete planned by an older version has nothing to search with
+    checks = [op for op in ops if op['op'] == 'create' or
+              (op['op'] == 'delete' and 'search' in op)]
+    if not checks:
+        return []
+    body = [{'method': 'GET', 'object': op['obj_type'],
+             'data': op['payload'] if op['op'] == 'create' else op['search']}
+            for op in checks]
+    reply = conn.session.post(
+        conn.wapi_url + 'request', data=json.dumps(body),
+        headers={'Content-type': 'application/json'},
+        timeout=conn.http_request_timeout)
+    if reply.status_code != 200:
+        raise JournalError("bulk verification failed: {}".format(reply.content))
+    results = json.loads(reply.content)
+    failed = []
+    for op, found in zip(checks, results):
+        if op['op'] == 'create' and not found:
+            failed.append(op)
+        elif op['op'] == 'delete' and op['ref'] in [rec['_ref'] for rec in found]:
+            failed.append(op)
+    return failed
+
+
+def file_digest(path):
+    """ sha1 of the content of path """
+    with open(path, 'rb') as bfile:
+        return hashlib.sha1(bfile.read()).hexdigest()
+
+
+def read_batch(batch_file):
+    """ yield the line number and the fields of every non empty, non comment
+        line of batch_file """
+    with open(batch_file) as bfile:
+        for lineno, line in enumerate(bfile, 1):
+            fields = line.split('#')[0].split()
+            if fields:
+                yield lineno, fields
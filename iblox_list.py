@@ -3,41 +3,294 @@
 """
   esoteric requirements:
     - infoblox-client (installable through pip)
+    - numpy (installable through pip), only for --report
 """
 import os
-import platform
-import ConfigParser
-from infoblox_client import connector
+import csv
+import json
+import socket
+import argparse
+import functools
+import textwrap
+import ipaddress
+import iblox_engine
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
-if platform.system() == 'Windows':
-    IBLOX_CONF = os.path.join(os.path.expanduser('~'), 'iblox.cfg')
-else:
-    IBLOX_CONF = os.path.join(os.environ['HOME'], '.ibloxrc')
+REPORT_FIELDS = ['network', 'size', 'used', 'free', 'utilisation', 'largest_free_block',
+                 'host_records', 'a_records', 'overlap']
+
+# addresses spanned by a bitmap (two bytes each) instead of a sort: a /8 at most
+BITMAP_SPAN = 1 << 24
+
+
+def parse():
+    """ parse arguments """
+
+    intro = """\
+        With this script you can list the free IPs on Infoblox
+        ------------------------------------------------------
+        Listing: iblox_list.py
+        Reporting: iblox_list.py --report --format json --output report.json
+        Hint: the report shows, for each network, the utilisation, the largest free
+              block and the addresses used by both a host record and an A/AAAA record
+         """
+    parser = argparse.ArgumentParser(
+        formatter_class=lambda prog:
+        argparse.RawDescriptionHelpFormatter(prog, max_help_position=33),
+        description=textwrap.dedent(intro),
+        epilog="Author: Massimiliano Adamo <massimiliano.adamo@geant.org>")
+
+    parser.add_argument('--report', help='write the utilisation report', action='store_true')
+    parser.add_argument('--format', help='report format', choices=['csv', 'json'],
+                        default='csv')
+    parser.add_argument('--output', help='report file. Default: stdout')
+    parser.add_argument('--ipv4-scope', help='IPv4 space of the report', default='62.40.96.0/19')
+    parser.add_argument('--ipv4-prefix', help='size of the IPv4 networks', type=int,
+                        choices=range(16, 31), default=24)
+    parser.add_argument('--ipv6-scope', help='IPv6 space of the report (/64 networks), optional')
+
+    return parser.parse_args()
+
+
+def scope_regex(scope):
+    """ coarse server side filter for scope, made of its leading octets/hextets.
+        The exact filtering happens on the packed arrays """
+    if scope.version == 4:
+        octets = str(scope.network_address).split('.')[:scope.prefixlen // 8]
+        return '^' + ''.join(octet + r'\.' for octet in octets)
+    hextets = []
+    for hextet in scope.network_address.exploded.split(':')[:scope.prefixlen // 16]:
+        if int(hextet, 16) == 0:
+            break
+        hextets.append(hextet.lstrip('0') + ':')
+    return '^' + ''.join(hextets)
+
+
+def fetch_addresses(conn, obj_type, field, regex):
+    """ return the addresses (field is ipv4addr or ipv6addr) of the obj_type
+        records matching regex """
+    if obj_type == 'record:host':
+        records = iblox_engine.fetch_all(conn, obj_type, {field + '~': regex}, [field + 's'])
+        return [str(addr[field]) for rec in records for addr in rec[field + 's']]
+    records = iblox_engine.fetch_all(conn, obj_type, {field + '~': regex}, [field])
+    return [str(rec[field]) for rec in records]
+
+
+def pack_ipv4(addresses):
+    """ uint64 array of IPv4 addresses, parsed by numpy in a single pass """
+    octets = numpy.fromstring('.'.join(addresses), dtype=numpy.uint64, sep='.')
+    if len(octets) != 4 * len(addresses):
+        raise ValueError("malformed IPv4 address among the fetched records")
+    return octets.reshape(-1, 4).dot(numpy.array([1 << 24, 1 << 16, 1 << 8, 1], numpy.uint64))
+
+
+def pack_ipv6(addresses):
+    """ (hi, lo) uint64 arrays of IPv6 addresses. numpy can't parse them: a
+        vectorised parser of the '::' forms was five times slower than
+        inet_pton """
+    packed = ''.join(map(functools.partial(socket.inet_pton, socket.AF_INET6), addresses))
+    halves = numpy.frombuffer(packed, dtype='>u8').reshape(-1, 2)
+    return halves[:, 0].astype(numpy.uint64), halves[:, 1].astype(numpy.uint64)
+
+
+def split_ipv4(addrs, scope, prefix):
+    """ return (network, offset) arrays of the addresses within scope """
+    scope_mask = numpy.uint64((1 << 32) - (1 << (32 - scope.prefixlen)))
+    addrs = addrs[(addrs & scope_mask) == numpy.uint64(int(scope.network_address))]
+    return (addrs >> numpy.uint64(32 - prefix),
+            addrs & numpy.uint64((1 << (32 - prefix)) - 1))
+
+
+def split_ipv6(addrs, scope):
+    """ return (/64 network, offset) arrays of the addresses within scope """
+    hi, lo = addrs
+    scope_mask = numpy.uint64((1 << 64) - (1 << (64 - min(scope.prefixlen, 64))))
+    within = (hi & scope_mask) == numpy.uint64(int(scope.network_address) >> 64)
+    return hi[within], lo[within]
+
+
+def pair_keys(nets, offsets, host_bits):
+    """ keys sorting like the (network, offset) pairs: the addresses """
+    if host_bits < 64:
+        return (nets << numpy.uint64(host_bits)) | offsets
+    # a /64 offset takes the whole uint64: the 16 big-endian bytes sort as the address
+    packed = numpy.empty((len(nets), 2), dtype='>u8')
+    packed[:, 0] = nets
+    packed[:, 1] = offsets
+    return packed.view('S16').ravel()
+
+
+def split_keys(keys, host_bits):
+    """ (network, offset) arrays of the keys returned by pair_keys() """
+    if host_bits < 64:
+        return keys >> numpy.uint64(host_bits), keys & numpy.uint64((1 << host_bits) - 1)
+    halves = numpy.ascontiguousarray(keys).view('>u8').reshape(-1, 2)
+    return halves[:, 0].astype(numpy.uint64), halves[:, 1].astype(numpy.uint64)
 
-IBLOX_CONF_CONTENT = """[iblox]\n
-# Infoblox server <string>: infblox server fqdn
-iblox_server = infoblox.foo.bar.com\n
-# Infoblox username <string>: your_username
-iblox_username = your_username\n
-# Infoblox password <string>: your_password
-iblox_password = your_secret_pass_here\n
-"""
+
+def merge_addresses(host_keys, a_keys):
+    """ return the sorted unique keys of both arrays and, for each of them,
+        whether host records and A/AAAA records use it """
+    keys = numpy.concatenate([host_keys, a_keys])
+    if not len(keys):
+        return keys, numpy.zeros(0, bool), numpy.zeros(0, bool)
+    if keys.dtype == numpy.uint64 and keys.max() - keys.min() < BITMAP_SPAN:
+        # an IPv4 scope fits a bitmap: no sort at all
+        base = keys.min()
+        by_host = numpy.zeros(int(keys.max() - base) + 1, bool)
+        by_a = numpy.zeros(len(by_host), bool)
+        by_host[host_keys - base] = True
+        by_a[a_keys - base] = True
+        used = numpy.flatnonzero(by_host | by_a)
+        return used.astype(numpy.uint64) + base, by_host[used], by_a[used]
+    is_host = numpy.arange(len(keys)) < len(host_keys)
+    order = numpy.argsort(keys)
+    keys, is_host = keys[order], is_host[order]
+    starts = numpy.flatnonzero(numpy.concatenate([[True], keys[1:] != keys[:-1]]))
+    return (keys[starts], numpy.logical_or.reduceat(is_host, starts),
+            numpy.logical_or.reduceat(~is_host, starts))
+
+
+def count_per_network(nets, all_nets):
+    """ number of items of the sorted nets array falling in each of all_nets """
+    return (numpy.searchsorted(nets, all_nets, 'right') -
+            numpy.searchsorted(nets, all_nets, 'left'))
+
+
+def largest_free_block(nets, offsets, all_nets, last):
+    """ size of the largest free block in each of all_nets: nets and offsets are
+        sorted and unique, offset 0 and last (network/broadcast) are never free """
+    first = numpy.searchsorted(nets, all_nets, 'left')
+    end = numpy.searchsorted(nets, all_nets, 'right')
+    largest = numpy.full(len(all_nets), last - numpy.uint64(1), numpy.uint64)
+    used = end > first
+    if not used.any():
+        return largest
+    # gap following each address, 0 on the last address of a network
+    gaps = numpy.zeros(len(nets), numpy.uint64)
+    same_net = nets[1:] == nets[:-1]
+    gaps[:-1][same_net] = offsets[1:][same_net] - offsets[:-1][same_net] - numpy.uint64(1)
+    first, end = first[used], end[used]
+    largest[used] = numpy.maximum.reduce([
+        offsets[first] - numpy.uint64(1),
+        last - numpy.uint64(1) - offsets[end - 1],
+        numpy.maximum.reduceat(gaps, first)])
+    return largest
+
+
+def network_report(hosts, a_recs, host_bits, all_nets=None):
+    """ utilisation columns of each network: hosts and a_recs are the
+        (network, offset) arrays of host and A/AAAA records. Without all_nets
+        only the networks in use are reported """
+    size = 1 << host_bits
+    last = numpy.uint64(size - 1)
+    keys, by_host, by_a = merge_addresses(pair_keys(hosts[0], hosts[1], host_bits),
+                                          pair_keys(a_recs[0], a_recs[1], host_bits))
+    nets, offsets = split_keys(keys, host_bits)
+
+    # records on the network/broadcast address are weird ones, not usable addresses
+    usable = (offsets > 0) & (offsets < last)
+    if all_nets is None:
+        all_nets = numpy.unique(nets)
+    used = count_per_network(nets[usable], all_nets)
+    return all_nets, {
+        'size': [size] * len(all_nets),
+        'used': used.tolist(),
+        'host_records': count_per_network(nets[by_host], all_nets).tolist(),
+        'a_records': count_per_network(nets[by_a], all_nets).tolist(),
+        'overlap': count_per_network(nets[by_host & by_a], all_nets).tolist(),
+        # a /64 holds more addresses than an int64
+        'free': [size - 2 - count for count in used.tolist()],
+        'utilisation': numpy.round(100.0 * used / (size - 2), 4).tolist(),
+        'largest_free_block': largest_free_block(
+            nets[usable], offsets[usable], all_nets, last).tolist()
+        }
+
+
+def to_rows(networks, columns):
+    """ turn the network names and the report columns into rows """
+    names = ['network'] + list(columns)
+    return [dict(zip(names, values)) for values in zip(networks, *columns.values())]
+
+
+def report_ipv4(hosts, a_recs, scope, prefix):
+    """ report rows for every /prefix network of scope """
+    first = int(scope.network_address) >> (32 - prefix)
+    all_nets = numpy.arange(first, first + (1 << (prefix - scope.prefixlen)), dtype=numpy.uint64)
+    all_nets, columns = network_report(split_ipv4(hosts, scope, prefix),
+                                       split_ipv4(a_recs, scope, prefix), 32 - prefix, all_nets)
+    packed = (all_nets << numpy.uint64(32 - prefix)).astype('>u4').tostring()
+    networks = ['{}/{}'.format(socket.inet_ntoa(packed[idx:idx + 4]), prefix)
+                for idx in range(0, len(packed), 4)]
+    return to_rows(networks, columns)
+
+
+def report_ipv6(hosts, aaaa_recs, scope):
+    """ report rows for every /64 network of scope holding a record """
+    all_nets, columns = network_report(split_ipv6(hosts, scope),
+                                       split_ipv6(aaaa_recs, scope), 64)
+    packed = all_nets.astype('>u8').tostring()
+    networks = ['{}/64'.format(socket.inet_ntop(socket.AF_INET6, packed[idx:idx + 8] + '\0' * 8))
+                for idx in range(0, len(packed), 8)]
+    return to_rows(networks, columns)
+
+
+def write_report(rows, out_format, out_file):
+    """ write the report rows as csv or json """
+    if out_format == 'json':
+        json.dump(rows, out_file, indent=2, sort_keys=True)
+        out_file.write('\n')
+    else:
+        writer = csv.DictWriter(out_file, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def report(ipv4_scope, ipv4_prefix, ipv6_scope, out_format, output=None):
+    """ fetch every used address of the scopes and write the utilisation report
+        to output, or to stdout """
+    if numpy is None:
+        print "numpy is needed to build the report (installable through pip)"
+        os.sys.exit(1)
+    conn = iblox_engine.connect()
+    rows = []
+    try:
+        if ipv4_scope:
+            scope = ipaddress.ip_network(ipv4_scope.decode('utf-8'))
+            regex = scope_regex(scope)
+            rows.extend(report_ipv4(
+                pack_ipv4(fetch_addresses(conn, 'record:host', 'ipv4addr', regex)),
+                pack_ipv4(fetch_addresses(conn, 'record:a', 'ipv4addr', regex)),
+                scope, max(ipv4_prefix, scope.prefixlen)))
+        if ipv6_scope:
+            scope = ipaddress.ip_network(ipv6_scope.decode('utf-8'))
+            regex = scope_regex(scope)
+            rows.extend(report_ipv6(
+                pack_ipv6(fetch_addresses(conn, 'record:host', 'ipv6addr', regex)),
+                pack_ipv6(fetch_addresses(conn, 'record:aaaa', 'ipv6addr', regex)),
+                scope))
+    except (iblox_engine.WapiError, ValueError) as err:
+        # a missing page would show used networks as free: no report at all
+        print err
+        print "giving up..."
+        os.sys.exit(1)
+    if output:
+        with open(output, 'w') as out_file:
+            write_report(rows, out_format, out_file)
+    else:
+        write_report(rows, out_format, os.sys.stdout)
 
 
 def span_ipv4(start=96):
     """ span IPv4 from 62.40.96.1 to 62.40.127.254 """
     net_prefix = '62.40.'
-    config = ConfigParser.RawConfigParser()
-    config.readfp(open(IBLOX_CONF))
-    opts = {
-        'host': config.get('iblox', 'iblox_server'),
-        'username': config.get('iblox', 'iblox_username'),
-        'password': config.get('iblox', 'iblox_password')
-        }
-    conn = connector.Connector(opts)
+    conn = iblox_engine.connect()
 
     def yield_ipv4(scope):
         """ return generator with IPv4 """
@@ -82,6 +335,12 @@ def span_ipv4(start=96):
 if __name__ == '__main__':
     requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+    ARGS = parse()
+
+    if ARGS.report:
+        report(ARGS.ipv4_scope, ARGS.ipv4_prefix, ARGS.ipv6_scope, ARGS.format, ARGS.output)
+        os.sys.exit()
+
     print "searching free IPs v4 available on each network from 62.40.96.1 to 62.40.127.254"
     print '-'*80
 
@@ -1,49 +1,27 @@
 #!/usr/bin/python
 #
 """
-  THIS SCRIPT IS A BROKEN PLACE-HOLDER
   esoteric requirements:
     - infoblox-client (installable through pip)
 """
 import os
 import argparse
 import textwrap
-import platform
-import ConfigParser
-from infoblox_client import connector
-from infoblox_client import objects
+import iblox_engine
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
-# since the script is broken let's print a message and say good bye
-print "this script is still not working"
-os.sys.exit()
-
-if platform.system() == 'Windows':
-    IBLOX_CONF = os.path.join(os.path.expanduser('~'), 'iblox.cfg')
-else:
-    IBLOX_CONF = os.path.join(os.environ['HOME'], '.ibloxrc')
-
-IBLOX_CONF_CONTENT = """[iblox]\n
-# Infoblox server <string>: infblox server fqdn
-iblox_server = infoblox.foo.bar.com\n
-# Infoblox username <string>: your_username
-iblox_username = your_username\n
-# Infoblox password <string>: your_password
-iblox_password = your_secret_pass_here\n
-"""
-
 
 def parse():
     """ parse arguments """
 
     intro = """\
-        With this script you can add/replace/destroy a CNAME record on Infoblox
-        -----------------------------------------------------------------------
-        Adding: iblox.py --host test-foo01.bar.com --txt "txt string here"
-        Removing: iblox.py --txt foo.bar.com --destroy
-        Hint: If you add a txt, you will implicitly replace any existing entry which is
-              different from the one provided to the script
+        With this script you can add/replace/destroy a TXT record on Infoblox
+        ---------------------------------------------------------------------
+        Adding: iblox_txt.py --host test-foo01.bar.com --txt "txt string here"
+        Removing: iblox_txt.py --host test-foo01.bar.com --destroy
+        Hint: a host can hold several txt records: adding one leaves the others in place,
+              --destroy without --txt removes all of them
          """
     parser = argparse.ArgumentParser(
         formatter_class=lambda prog:
@@ -51,8 +29,8 @@ def parse():
         description=textwrap.dedent(intro),
         epilog="Author: Massimiliano Adamo <massimiliano.adamo@geant.org>")
 
-    parser.add_argument('--host', help='existing host name. Mandatory when creating a txt')
-    parser.add_argument('--txt', help='txt to create. Mandatory', required=True)
+    parser.add_argument('--host', help='host name of the txt. Mandatory', required=True)
+    parser.add_argument('--txt', help='txt to create. Mandatory when creating a txt')
     parser.add_argument('--network', help='network Internal/External',
                         choices=['External', 'Internal'], required=True)
     parser.add_argument('--destroy', help='destroy txt', action='store_true')
@@ -60,78 +38,34 @@ def parse():
     return parser.parse_args()
 
 
-class Iblox(object):
-    """manage infoblox entries"""
-    config = ConfigParser.RawConfigParser()
+class Iblox(iblox_engine.Iblox):
+    """manage infoblox TXT entries"""
 
-    def __init__(self, network, record, txt):
-        self.network = network
+    def __init__(self, network, record, txt, conn=None):
+        super(Iblox, self).__init__(network, conn)
         self.record = record
         self.txt = txt
-        self.config.readfp(open(IBLOX_CONF))
-        self.opts = {
-            'host': self.config.get('iblox', 'iblox_server'),
-            'username': self.config.get('iblox', 'iblox_username'),
-            'password': self.config.get('iblox', 'iblox_password')
-            }
-        self.conn = connector.Connector(self.opts)
-
-    def query_txt(self):
-        """ query for CNAME record: return None if it does not exist or
-            if self.txt matches the existing one """
-        try:
-            txt_rec = self.conn.get_object('record:txt', {'name': self.txt})[0]
-        except TypeError:
-            return None
-        else:
-            if self.record == str(txt_rec['canonical']):
-                return 'already_there'
-            else:
-                return txt_rec
 
     def destroy(self):
-        """ clean up CNAME entry """
-        try:
-            self.conn.delete_object(self.conn.get_object(
-                'record:cname', {'name': self.txt})[0]['_ref'])
-        except TypeError:
-            print "cound not find CNAME {}".format(self.txt)
-        else:
-            print "destroyed CNAME {}".format(self.txt)
-
-    def destroy_conditional(self):
-        """ clean up host entries """
-        txt_entry = self.query_txt()
-        if txt_entry and txt_entry != 'already_there':
-            self.conn.delete_object(txt_entry['_ref'])
-            print "destroyed CNAME record {}".format(self.txt_entry)
-            return 'did something'
-        elif txt_entry == 'already_there':
-            return 'already_there'
+        """ clean up TXT entries: only the one matching self.txt if there is one """
+        if self.txt:
+            ops = self.plan_destroy(iblox_engine.TXT, name=self.record, text=self.txt)
         else:
-            return None
-
-    def rebuild(self):
-        """ - destroy txt record (if it is not matching)
-            - create a new txt record if there isn't one already
+            ops = self.plan_destroy(iblox_engine.TXT, name=self.record)
+        if not ops:
+            print "could not find TXT {}".format(self.record)
+        self.run(ops)
+
+    def plan(self):
+        """ return the operations needed to add the txt: a new txt record
+            is created if there isn't one already. The other txt records of
+            the host are left in place
         """
+        return self.plan_record(iblox_engine.TXT, name=self.record, text=self.txt)
 
-        try_destroy = self.destroy_conditional()
-
-        if try_destroy == 'already_there':
-            print "A TXT {} associated to {} is already there".format(
-                self.txt, self.record)
-        else:
-            try:
-                objects.InfobloxObject.create(self.conn, view=self.network,
-                                              name=self.record, text=self.txt)
-            except Exception as err:
-                print "couldn't create TXT record \"{}\" associated to {}: {}".format(
-                    self.txt, self.record, err)
-                os.sys.exit(1)
-            else:
-                print "created TXT record {} associated to {}".format(
-                    self.txt, self.record)
+    def rebuild(self):
+        """ run the operations returned by plan() """
+        self.run(self.plan())
 
         print '-'*74
 
@@ -140,30 +74,21 @@ if __name__ == '__main__':
     print '-'*74
     requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
-    if not os.access(IBLOX_CONF, os.W_OK):
-        CONF_FILE = open(IBLOX_CONF, 'w+')
-        CONF_FILE.write(IBLOX_CONF_CONTENT)
-        CONF_FILE.close()
-        print "\nThe following file has been created: {0}\n".format(IBLOX_CONF)
-        print "Fill it with proper values and run the script again\n"
-        os.sys.exit(1)
+    iblox_engine.check_config()
 
     ARGS = parse()
 
-    if not ARGS.destroy:
-        if not ARGS.host:
-            print " --host is mandatory when you create a new record"
-            print " You can use --help to check the options"
-            os.sys.exit()
-        else:
-            HOST = ARGS.host
-    else:
-        if not ARGS.host:
-            HOST = 'blah'
+    if not ARGS.destroy and not ARGS.txt:
+        print " --txt is mandatory when you create a new record"
+        print " You can use --help to check the options"
+        os.sys.exit()
 
-    if ARGS.destroy:
-        Iblox(HOST, ARGS.txt).destroy()
-    else:
-        Iblox(HOST, ARGS.txt).rebuild()
-
-    os.sys.exit()
+    try:
+        if ARGS.destroy:
+            Iblox(ARGS.network, ARGS.host, ARGS.txt).destroy()
+        else:
+            Iblox(ARGS.network, ARGS.host, ARGS.txt).rebuild()
+    except iblox_engine.WapiError as err:
+        print err
+        print "giving up..."
+        os.sys.exit(1)